@@ -1,7 +1,11 @@
 import os
+import queue
+import random
 import sqlite3
+import types
+from contextlib import contextmanager
 import click # Import click for CLI commands
-from flask import Flask, request, render_template, url_for, redirect, g
+from flask import Flask, request, render_template, url_for, redirect, g, jsonify, Response, stream_template
 
 app = Flask(__name__)
 
@@ -16,44 +20,175 @@ else:
 # Store full path
 app.config['DATABASE_PATH'] = os.path.join(os.path.dirname(__file__), DATABASE) 
 
+# Resolve paths once at import; connecting by absolute path also means the same
+# file is used no matter which directory `flask run` was started from
+_CFG = types.SimpleNamespace(
+    db_path=app.config['DATABASE_PATH'],
+    schema=os.path.join(os.path.dirname(__file__), 'schema.sql'),
+    ranks_schema=os.path.join(os.path.dirname(__file__), 'ranks.sql'),
+)
+
+# --- SQL ---
+# Shared query text so every call hits the connection's prepared statement cache
+
+SQL_COUNT_ITEMS = 'SELECT count(id), max(id) FROM items'
+SQL_ALL_ITEMS = 'SELECT id, name FROM items'
+SQL_ITEMS_BY_IDS = 'SELECT id, name FROM items WHERE id IN ({placeholders})'
+SQL_ITEM_AT_OFFSET = 'SELECT id, name FROM items ORDER BY id LIMIT 1 OFFSET ?'
+SQL_INSERT_ITEM = 'INSERT INTO items (name) VALUES (?) RETURNING id, name'
+SQL_INSERT_COMPARISON = 'INSERT INTO comparisons (item1_id, item2_id, score) VALUES (?, ?, ?)'
+# Ranks are kept up to date in item_ranks by triggers on comparisons
+# (see ranks.sql). Items without comparisons rank 0.
+SQL_RANKED_ITEMS = ('SELECT i.id, i.name, COALESCE(r.rank, 0) AS rank '
+                    'FROM items i '
+                    'LEFT JOIN item_ranks r ON r.item_id = i.id '
+                    'ORDER BY rank DESC')
+SQL_CLEAR_RANKS = 'DELETE FROM item_ranks'
+SQL_BACKFILL_RANKS = ('INSERT INTO item_ranks (item_id, rank) '
+                      'SELECT item_id, SUM(score) FROM '
+                      '(SELECT item1_id AS item_id, score FROM comparisons '
+                      'UNION ALL SELECT item2_id, -score FROM comparisons) '
+                      # Databases from before foreign_keys=ON can hold comparisons
+                      # of deleted items; those can't have an item_ranks row
+                      'WHERE item_id IN (SELECT id FROM items) '
+                      'GROUP BY item_id')
+SQL_LIST_ITEMS = 'SELECT id, name FROM items ORDER BY id'
+SQL_LIST_COMPARISONS = 'SELECT item1_id, item2_id, score FROM comparisons ORDER BY item1_id, item2_id'
+
+def configure_connection(conn):
+    """Applies the connection-scoped PRAGMAs."""
+    conn.execute('PRAGMA synchronous=NORMAL') # Safe with WAL, skips the per-commit fsync
+    conn.execute('PRAGMA cache_size=-20000') # ~20MB page cache
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456') # 256MB
+    conn.execute('PRAGMA foreign_keys=ON')
+    conn.execute('PRAGMA busy_timeout=5000') # Wait up to 5s for a competing writer
+
+# Long-lived connections shared across requests; opening a connection costs
+# several file opens plus the PRAGMAs above, so reuse them instead
+POOL_SIZE = 8
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+# WAL mode is stored in the database file, so it is only set by the first
+# connection this process opens rather than on every connection
+_wal_enabled = False
+
+def create_connection(db_path):
+    """Opens a new pooled connection and applies the connection-scoped PRAGMAs."""
+    # sqlite3 connections are safe to share between threads (one at a time)
+    # isolation_level=None: transactions are opened explicitly, see write_transaction()
+    # cached_statements: room for every query above, with headroom (default 128)
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    try:
+        conn.row_factory = sqlite3.Row
+        configure_connection(conn)
+        global _wal_enabled
+        if not _wal_enabled:
+            # WAL lets readers run alongside the writer. The PRAGMA returns the
+            # resulting mode rather than raising when it can't switch
+            journal_mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if journal_mode == 'wal':
+                _wal_enabled = True
+            else:
+                app.logger.warning(f"Could not enable WAL for {db_path}, journal mode is {journal_mode}")
+    except Exception:
+        conn.close()
+        raise
+    app.logger.debug(f"Database connection opened to {db_path}")
+    return conn
+
 #Connect database
-def get_db_connection():
-    """Gets a database connection. The connection is associated with the application context."""
-    if 'db' not in g:
-        # Ensure the directory exists if DATABASE includes a path (though not strictly needed here)
-        # db_path = app.config['DATABASE_PATH']
-        # os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        # g.db = sqlite3.connect(db_path)
-
-        # Connect using the DATABASE name relative to the app's root path
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
-        app.logger.debug(f"Database connection opened to {DATABASE}")
-    return g.db
+def _make_get_db(cfg):
+    """Builds get_db_connection with the database path bound as a free variable."""
+    db_path = cfg.db_path
+    take_pooled = _pool.get_nowait
+
+    def get_db_connection():
+        """Gets a database connection. The connection is associated with the application context."""
+        if 'db' not in g:
+            try:
+                g.db = take_pooled()
+            except queue.Empty:
+                g.db = create_connection(db_path)
+        return g.db
+
+    return get_db_connection
+
+get_db_connection = _make_get_db(_CFG)
 
 def close_db(e=None):
-    """Closes the database connection."""
+    """Returns the database connection to the pool."""
     db = g.pop('db', None)
-    if db is not None:
+    if db is None:
+        return
+    if db.in_transaction:
+        # Writes commit through write_transaction(), so this is a leaked transaction
+        app.logger.warning("Request ended inside a database transaction; rolling it back")
+        try:
+            db.rollback()
+        except sqlite3.Error as rollback_error:
+            app.logger.error(f"Rollback failed, discarding connection: {rollback_error}")
+    # Only clean connections go back; the next checkout opens a fresh one instead
+    if db.in_transaction:
+        db.close()
+        return
+    try:
+        _pool.put_nowait(db)
+    except queue.Full:
         db.close()
-        app.logger.debug(f"Database connection closed for {DATABASE}")
+        app.logger.debug(f"Database connection closed for {_CFG.db_path}")
 
 # Use teardown_appcontext instead of teardown_request
 app.teardown_appcontext(close_db)
 
+@contextmanager
+def write_transaction(conn):
+    """Runs the block in a BEGIN IMMEDIATE transaction.
+
+    Taking the write lock up front means a competing writer is waited out
+    (busy_timeout) at BEGIN, instead of failing with SQLITE_BUSY when a
+    deferred transaction tries to upgrade mid-statement.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        # SQLite may already have rolled back (e.g. SQLITE_FULL, I/O errors);
+        # a second ROLLBACK would then mask the original error
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def run_script(db, script_path):
+    """Runs every statement in an SQL file."""
+    with open(script_path) as f:
+        db.executescript(f.read())
+
+def script_statements(script_path):
+    """Yields the statements of an SQL file one at a time."""
+    with open(script_path) as f:
+        statement = ''
+        for line in f:
+            statement += line
+            # complete_statement understands BEGIN...END bodies of triggers
+            if sqlite3.complete_statement(statement):
+                yield statement
+                statement = ''
+
 def init_db_logic():
     """Core logic to initialize the database. Separated for clarity."""
     db = get_db_connection() # Get connection managed by Flask context
-    schema_path = os.path.join(os.path.dirname(__file__), 'schema.sql')
     try:
-        with open(schema_path) as f:
-            db.executescript(f.read())
+        for script_path in (_CFG.schema, _CFG.ranks_schema):
+            run_script(db, script_path)
         db.commit()
         # No db.close() here! Let teardown_appcontext handle it.
-    except FileNotFoundError:
+    except FileNotFoundError as e:
         # Use click.echo for CLI feedback, app.logger for app logs
-        click.echo(f"Error: schema.sql not found at {schema_path}", err=True)
-        app.logger.error(f"schema.sql not found at {schema_path}")
+        click.echo(f"Error: {e.filename} not found", err=True)
+        app.logger.error(f"{e.filename} not found")
         raise # Re-raise the exception so the command fails clearly
     except sqlite3.Error as e:
         click.echo(f"Error initializing database: {e}", err=True)
@@ -77,32 +212,91 @@ def init_db_command():       # The function Flask calls for 'init-db'
          import sys
          sys.exit(1) # Exit with error code if init_db_logic failed
 
+def migrate_ranks_logic():
+    """Adds item_ranks and its triggers to an existing database and fills it in.
+
+    Idempotent: the DDL uses IF NOT EXISTS and the backfill recomputes every
+    rank from comparisons, so it can be re-run to repair drifted ranks too.
+    """
+    db = get_db_connection()
+    try:
+        # One transaction for the DDL and the backfill, so a failure leaves no
+        # half-created item_ranks behind (executescript would commit the DDL)
+        with write_transaction(db):
+            for statement in script_statements(_CFG.ranks_schema):
+                db.execute(statement)
+            db.execute(SQL_CLEAR_RANKS)
+            db.execute(SQL_BACKFILL_RANKS)
+    except FileNotFoundError as e:
+        click.echo(f"Error: {e.filename} not found", err=True)
+        app.logger.error(f"{e.filename} not found")
+        raise
+    except sqlite3.Error as e:
+        click.echo(f"Error migrating ranks: {e}", err=True)
+        app.logger.error(f"Error migrating ranks: {e}")
+        raise
+
+@app.cli.command('migrate-ranks')
+def migrate_ranks_command():
+    """Create item_ranks in an existing database without losing data."""
+    try:
+        migrate_ranks_logic()
+        click.echo(f"Migrated ranks in the database '{app.config.get('DATABASE', 'UNKNOWN')}'.")
+    except Exception:
+         import sys
+         sys.exit(1)
+
 
 
 # --- Routes  ---
 
-@app.before_request
-def before_request():
-    """Ensures that a database connection is available before each request."""
-    # This is technically redundant if all routes call get_db_connection(),
-    # but doesn't hurt.
-    get_db_connection()
+# Below this many items /compare samples with one scan instead of id lookups
+RESERVOIR_THRESHOLD = 100
+
+def sample_items(conn):
+    """Picks two distinct random items in a single pass (reservoir sampling)."""
+    reservoir = []
+    for seen, row in enumerate(conn.execute(SQL_ALL_ITEMS), 1):
+        if seen <= 2:
+            reservoir.append(row)
+        else:
+            slot = random.randrange(seen)
+            if slot < 2:
+                reservoir[slot] = row
+    random.shuffle(reservoir) # The scan order would otherwise decide which side each item is on
+    return reservoir[0], reservoir[1]
+
+def pick_random_items(conn, max_id, count):
+    """Picks two distinct random items by primary key instead of sorting the table."""
+    # Sample candidate ids and keep the ones that still exist (deletions leave gaps)
+    for _ in range(3):
+        candidate_ids = random.sample(range(1, max_id + 1), k=min(32, max_id))
+        placeholders = ', '.join('?' * len(candidate_ids))
+        rows = {row['id']: row for row in conn.execute(
+            SQL_ITEMS_BY_IDS.format(placeholders=placeholders), candidate_ids)}
+        found = [rows[item_id] for item_id in candidate_ids if item_id in rows]
+        if len(found) >= 2:
+            return found[0], found[1]
+
+    # Very sparse ids: step to two distinct random positions in id order instead
+    offset1, offset2 = random.sample(range(count), 2)
+    return tuple(conn.execute(SQL_ITEM_AT_OFFSET, (offset,)).fetchone()
+                 for offset in (offset1, offset2))
+
 
 @app.route('/compare', methods=['GET'])
 def compare_items():
     """Compares two random items."""
     conn = get_db_connection()
     try:
-        items = conn.execute('SELECT id, name FROM items ORDER BY RANDOM() LIMIT 2').fetchall()
-        if len(items) == 2:
-            return render_template('compare.html', item1=items[0], item2=items[1])
+        count, max_id = conn.execute(SQL_COUNT_ITEMS).fetchone()
+        if count < 2:
+            return "Not enough items in the database to compare (need at least 2)."
+        if count < RESERVOIR_THRESHOLD:
+            item1, item2 = sample_items(conn)
         else:
-            # Check if items table exists but is empty
-            item_count_row = conn.execute("SELECT count(id) FROM items").fetchone()
-            if item_count_row and item_count_row[0] < 2:
-                 return "Not enough items in the database to compare (need at least 2)."
-            else: # Should not happen if RANDOM() works, but defensive coding
-                 return "Could not fetch two distinct items."
+            item1, item2 = pick_random_items(conn, max_id, count)
+        return render_template('compare.html', item1=item1, item2=item2)
     except sqlite3.OperationalError as e:
          app.logger.error(f"Database error in /compare: {e}")
          if "no such table: items" in str(e):
@@ -114,67 +308,34 @@ def record_comparison():
     """Records a comparison between two items."""
     conn = get_db_connection()
     try:
-        item1_id = request.form['item1_id']
-        item2_id = request.form['item2_id']
+        # Bind ids as ints so SQLite stores them without coercing from text
+        item1_id = int(request.form['item1_id'])
+        item2_id = int(request.form['item2_id'])
         preference = int(request.form['preference']) # Ensure preference is integer
 
-        conn.execute('INSERT INTO comparisons (item1_id, item2_id, score) VALUES (?, ?, ?)',
-                     (item1_id, item2_id, preference))
-        conn.commit()
+        with write_transaction(conn): # Commits on success, rolls back if the insert raises
+            conn.execute(SQL_INSERT_COMPARISON, (item1_id, item2_id, preference))
     except (KeyError, ValueError) as e:
         app.logger.warning(f"Invalid form data for comparison: {e}")
-        conn.rollback()
         # Consider flashing a message to the user
         # flash("Invalid data submitted for comparison.")
     except sqlite3.IntegrityError as e:
         app.logger.warning(f"Integrity error during comparison insert: {e}")
-        conn.rollback()
         # flash("Could not record comparison due to a database constraint.")
     except sqlite3.OperationalError as e:
          app.logger.error(f"Database error in /record_comparison: {e}")
          return f"Database error: {e}. Did you run 'flask init-db'?", 500
     except Exception as e:
         app.logger.error(f"Unexpected error in /record_comparison: {e}")
-        conn.rollback()
         return "An unexpected error occurred.", 500
 
     return redirect(url_for('index'))
 
 
-def calculate_relative_rank(item_id):
-    """Calculates the relative rank of an item based on comparisons."""
-    conn = get_db_connection()
-    total_score = 0
-    try:
-        # Ensure item_id is treated as an integer if it's numeric in the DB
-        item_id_int = int(item_id)
-        comparisons = conn.execute(
-            'SELECT score, item1_id, item2_id FROM comparisons WHERE item1_id = ? OR item2_id = ?',
-            (item_id_int, item_id_int)).fetchall()
-
-        for comparison in comparisons:
-            # Ensure comparison IDs are also treated as integers for comparison
-            comp_item1_id = int(comparison['item1_id'])
-            comp_item2_id = int(comparison['item2_id'])
-
-            if comp_item1_id == item_id_int:
-                # Ensure score is numeric before adding
-                total_score += int(comparison['score'])
-            elif comp_item2_id == item_id_int:
-                # Ensure score is numeric before negating
-                total_score -= int(comparison['score'])
-
-    except sqlite3.OperationalError as e:
-        app.logger.warning(f"Database error calculating rank for item {item_id}: {e}")
-        return 0 # Return a default rank or handle appropriately
-    except (ValueError, TypeError) as e:
-        app.logger.warning(f"Invalid data format during rank calculation for item {item_id}: {e}")
-        return 0
-    except Exception as e:
-        app.logger.error(f"Unexpected error calculating rank for item {item_id}: {e}")
-        return 0 # Default rank on unexpected error
-
-    return total_score
+def wants_json():
+    """True when the request comes from a script rather than a plain form post."""
+    return (request.accept_mimetypes.best == 'application/json'
+            or request.headers.get('X-Requested-With') == 'XMLHttpRequest')
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -185,35 +346,36 @@ def index():
         item_name = request.form.get('item_name') # Use .get for safety
         if item_name and item_name.strip(): # Basic validation: ensure name is not empty/whitespace
             try:
-                conn.execute('INSERT INTO items (name) VALUES (?)', (item_name.strip(),))
-                conn.commit()
+                with write_transaction(conn):
+                    # fetchall() finishes the statement so COMMIT isn't blocked by it
+                    item = conn.execute(SQL_INSERT_ITEM, (item_name.strip(),)).fetchall()[0]
             except sqlite3.OperationalError as e:
                  app.logger.error(f"Database error adding item in /: {e}")
                  return f"Database error: {e}. Did you run 'flask init-db'?", 500
             except Exception as e:
                  app.logger.error(f"Unexpected error adding item in /: {e}")
-                 conn.rollback()
                  return "An unexpected error occurred while adding the item.", 500
+            # Script clients get the new row back and patch the list themselves,
+            # skipping the redirect and the re-ranking GET
+            if wants_json():
+                return jsonify({'id': item['id'], 'name': item['name'], 'rank': 0}), 201
         else:
+            if wants_json():
+                return jsonify({'error': 'Item name cannot be empty.'}), 400
             # Optionally, provide feedback if the name is empty
             # flash('Item name cannot be empty.')
-            pass # Or handle as needed
         return redirect(url_for('index')) # Redirect even if POST fails or is empty
 
     # GET request part
-    ranked_items = []
     try:
-        items_data = conn.execute('SELECT id, name FROM items').fetchall()
-        for item in items_data:
-            rank = calculate_relative_rank(item['id'])
-            ranked_items.append({'id': item['id'], 'name': item['name'], 'rank': rank})
-
-        ranked_items.sort(key=lambda x: x['rank'], reverse=True)
+        ranked_items = conn.execute(SQL_RANKED_ITEMS).fetchall()
 
     except sqlite3.OperationalError as e:
         app.logger.error(f"Database error fetching items in /: {e}")
         if "no such table: items" in str(e):
              return "Database not initialized. Run 'flask init-db' first.", 500
+        elif "no such table: item_ranks" in str(e):
+             return "Database needs upgrading. Run 'flask migrate-ranks' first.", 500
         else:
              return f"Database error: {e}", 500
     except Exception as e:
@@ -228,13 +390,13 @@ def view_database():
     """Displays the raw contents of the database tables."""
     conn = get_db_connection()
     # Fetch all items, ordered by ID for consistency
-    all_items = conn.execute('SELECT id, name FROM items ORDER BY id').fetchall()
+    all_items = conn.execute(SQL_LIST_ITEMS)
     # Fetch all comparisons, ordered for consistency
-    all_comparisons = conn.execute('SELECT item1_id, item2_id, score FROM comparisons ORDER BY item1_id, item2_id').fetchall()
-    conn.close()
-    
-    # Pass the fetched data to a new template
-    return render_template('database_view.html', items=all_items, comparisons=all_comparisons)
+    all_comparisons = conn.execute(SQL_LIST_COMPARISONS)
+
+    # Stream the page so rows go straight from the cursors to the response
+    # instead of being collected into lists first
+    return Response(stream_template('database_view.html', items=all_items, comparisons=all_comparisons))
 
 
 
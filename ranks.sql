@@ -0,0 +1,32 @@
+-- Safe to run repeatedly: 'flask init-db' runs it after schema.sql, and
+-- 'flask migrate-ranks' runs it to upgrade a database created before item_ranks
+-- Running rank per item, kept in sync with comparisons by the triggers below
+CREATE TABLE IF NOT EXISTS item_ranks (
+    item_id INTEGER PRIMARY KEY,
+    rank INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (item_id) REFERENCES items(id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER IF NOT EXISTS comparisons_ai AFTER INSERT ON comparisons
+BEGIN
+    INSERT INTO item_ranks (item_id, rank) VALUES (NEW.item1_id, NEW.score)
+        ON CONFLICT(item_id) DO UPDATE SET rank = rank + NEW.score;
+    INSERT INTO item_ranks (item_id, rank) VALUES (NEW.item2_id, -NEW.score)
+        ON CONFLICT(item_id) DO UPDATE SET rank = rank - NEW.score;
+END;
+
+CREATE TRIGGER IF NOT EXISTS comparisons_ad AFTER DELETE ON comparisons
+BEGIN
+    UPDATE item_ranks SET rank = rank - OLD.score WHERE item_id = OLD.item1_id;
+    UPDATE item_ranks SET rank = rank + OLD.score WHERE item_id = OLD.item2_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS comparisons_au AFTER UPDATE OF item1_id, item2_id, score ON comparisons
+BEGIN
+    UPDATE item_ranks SET rank = rank - OLD.score WHERE item_id = OLD.item1_id;
+    UPDATE item_ranks SET rank = rank + OLD.score WHERE item_id = OLD.item2_id;
+    INSERT INTO item_ranks (item_id, rank) VALUES (NEW.item1_id, NEW.score)
+        ON CONFLICT(item_id) DO UPDATE SET rank = rank + NEW.score;
+    INSERT INTO item_ranks (item_id, rank) VALUES (NEW.item2_id, -NEW.score)
+        ON CONFLICT(item_id) DO UPDATE SET rank = rank - NEW.score;
+END;
@@ -1,10 +1,12 @@
+-- Drop referencing tables first so the drops pass foreign key checks
+DROP TABLE IF EXISTS comparisons;
+DROP TABLE IF EXISTS item_ranks;
 DROP TABLE IF EXISTS items;
 CREATE TABLE items (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
     rank INTEGER  -- Changed to allow NULL values
 );
-DROP TABLE IF EXISTS comparisons;
 CREATE TABLE comparisons (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     item1_id INTEGER NOT NULL,
@@ -15,3 +17,8 @@ CREATE TABLE comparisons (
     FOREIGN KEY (item2_id) REFERENCES items(id),
     UNIQUE (item1_id, item2_id)
 );
+-- Lets foreign key checks find comparisons by item2_id; item1_id is already
+-- the leading column of the UNIQUE (item1_id, item2_id) index
+CREATE INDEX IF NOT EXISTS idx_cmp_i2 ON comparisons(item2_id);
+
+-- item_ranks and its triggers are created from ranks.sql
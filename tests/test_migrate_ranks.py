@@ -0,0 +1,88 @@
+import queue
+import sqlite3
+import types
+
+import pytest
+
+import app as app_module
+
+# Schema as shipped before item_ranks existed (and before foreign keys were enforced)
+BASELINE_SCHEMA = """
+CREATE TABLE items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    rank INTEGER
+);
+CREATE TABLE comparisons (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item1_id INTEGER NOT NULL,
+    item2_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (item1_id) REFERENCES items(id),
+    FOREIGN KEY (item2_id) REFERENCES items(id),
+    UNIQUE (item1_id, item2_id)
+);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """A baseline-schema database, with the app pointed at it."""
+    db_path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(db_path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany('INSERT INTO items (name) VALUES (?)', [('a',), ('b',), ('c',)])
+    conn.executemany('INSERT INTO comparisons (item1_id, item2_id, score) VALUES (?, ?, ?)',
+                     [(1, 2, 1), (3, 1, 1), (2, 3, -1),
+                      (1, 99, 1)]) # Item 99 was deleted while foreign keys were off
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(app_module, '_pool', queue.LifoQueue(maxsize=app_module.POOL_SIZE))
+    monkeypatch.setattr(app_module, 'get_db_connection',
+                        app_module._make_get_db(types.SimpleNamespace(db_path=db_path)))
+    yield db_path
+    while not app_module._pool.empty():
+        app_module._pool.get_nowait().close()
+
+
+def ranks(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return dict(conn.execute(app_module.SQL_RANKED_ITEMS.replace('i.name, ', '')).fetchall())
+    finally:
+        conn.close()
+
+
+def table_exists(db_path, name):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def test_migrate_ranks_backfills_baseline_database(legacy_db):
+    result = app_module.app.test_cli_runner().invoke(args=['migrate-ranks'])
+    assert result.exit_code == 0, result.output
+    assert ranks(legacy_db) == {1: 1, 2: -2, 3: 2}
+
+
+def test_migrate_ranks_is_idempotent_and_triggers_keep_ranks(legacy_db):
+    runner = app_module.app.test_cli_runner()
+    assert runner.invoke(args=['migrate-ranks']).exit_code == 0
+    assert runner.invoke(args=['migrate-ranks']).exit_code == 0
+    assert ranks(legacy_db) == {1: 1, 2: -2, 3: 2}
+
+    client = app_module.app.test_client()
+    client.post('/record_comparison', data={'item1_id': 2, 'item2_id': 1, 'preference': 1})
+    assert ranks(legacy_db) == {1: 0, 2: -1, 3: 2}
+
+
+def test_failed_migration_leaves_no_item_ranks(legacy_db, monkeypatch):
+    monkeypatch.setattr(app_module, 'SQL_BACKFILL_RANKS', 'INSERT INTO no_such_table VALUES (1)')
+    result = app_module.app.test_cli_runner().invoke(args=['migrate-ranks'])
+    assert result.exit_code == 1
+    assert not table_exists(legacy_db, 'item_ranks')
+    assert not table_exists(legacy_db, 'comparisons_ai')